@@ -1,6 +1,5 @@
 import torch
 from torch.utils.data.dataset import Dataset
-from torch.autograd import Variable
 
 import numpy as np
 import random
@@ -18,7 +17,7 @@ class ZSLDataset(Dataset):
             gzsl        : Boolean for Generalized ZSL
             train       : Boolean indicating whether train/test
             synthetic   : Boolean indicating whether dataset is for synthetic examples
-            syn_dataset : A list consisting of 3-tuple (z, _, y) used for sampling
+            syn_dataset : A dataset consisting of 3-tuple (z, _, y) used for sampling
                           only when synthetic flag is True
         '''
         super(ZSLDataset, self).__init__()
@@ -31,11 +30,14 @@ class ZSLDataset(Dataset):
         self.device = device
 
         res101_data = scio.loadmat('./datasets/%s/res101.mat' % dset)
-        self.features = self.normalize(res101_data['features'].T)
+        # features are already extracted by ResNet101, keep them as a
+        # contiguous float32 array so batches need no further casting
+        self.features = np.ascontiguousarray(
+            self.normalize(res101_data['features'].T), dtype=np.float32)
         self.labels = res101_data['labels'].reshape(-1)
 
         self.attribute_dict = scio.loadmat('./datasets/%s/att_splits.mat' % dset)
-        self.attributes = self.attribute_dict['att'].T
+        self.attributes = np.ascontiguousarray(self.attribute_dict['att'].T, dtype=np.float32)
 
         # file with all class names for deciding train/test split
         self.class_names_file = './datasets/%s/classes.txt' % dset
@@ -143,6 +145,8 @@ class ZSLDataset(Dataset):
         if self.synthetic:
             # choose an example from synthetic dataset
             img_feature, orig_label, label_idx = self.syn_dataset[index]
+            # generated samples carry 0-d tensor labels, seen ones plain ints
+            orig_label, label_idx = int(orig_label), int(label_idx)
         else:
             # choose an example from original dataset
             img_feature, orig_label, label_idx = self.dataset[index]
@@ -1,6 +1,9 @@
 import torch
+import torch.distributed as dist
 from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
 import argparse
+import os
 
 from datautils import ZSLDataset
 from trainer import Trainer
@@ -17,6 +20,8 @@ parser.add_argument('--batch_size', type=int, default=128)
 parser.add_argument('--n_epochs', type=int, default=10)
 parser.add_argument('--use_cls_loss', action='store_true', default=False)
 parser.add_argument('--visualize', action='store_true', default=False)
+parser.add_argument('--compile', action='store_true', default=False)
+parser.add_argument('--critic_grad_accum', action='store_true', default=False)
 
 args = parser.parse_args()
 
@@ -40,25 +45,55 @@ else:
 
 n_epochs = args.n_epochs
 
+# multi GPU training when launched with torchrun, one process per GPU
+distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+if distributed:
+    dist.init_process_group('nccl')
+    local_rank = int(os.environ['LOCAL_RANK'])
+    torch.cuda.set_device(local_rank)
+    device = torch.device('cuda', local_rank)
+else:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+is_main = not distributed or dist.get_rank() == 0
+
+def log(*args, **kwargs):
+    # every rank sees only its own shard, so only rank 0 reports
+    if is_main:
+        print(*args, **kwargs)
+
 # trainer object for mini batch training
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(device)
+log(device)
 train_agent = Trainer(
     device, x_dim, args.latent_dim, attr_dim,
     n_train=n_train, n_test=n_test, gzsl=args.gzsl,
     n_critic=args.n_critic, lmbda=args.lmbda, beta=args.beta,
-    batch_size=args.batch_size
+    batch_size=args.batch_size, distributed=distributed, compile=args.compile,
+    critic_grad_accum=args.critic_grad_accum
 )
 
 params = {
     'batch_size': args.batch_size,
-    'shuffle': True,
     'num_workers': 0,
     'drop_last': True
 }
+# only the loaders over host-side features can be pinned; the synthetic
+# dataset already lives on the device
+pin_memory = device.type == 'cuda'
+
+def get_loader(dataset, pin_memory=False):
+    # each process gets its own shard of the dataset
+    sampler = DistributedSampler(dataset) if distributed else None
+    return DataLoader(
+        dataset, sampler=sampler, shuffle=sampler is None,
+        pin_memory=pin_memory, **params
+    )
+
+def set_epoch(loader, ep):
+    if distributed:
+        loader.sampler.set_epoch(ep)
 
 train_dataset = ZSLDataset(args.dataset, n_train, n_test, args.gzsl, device=device)
-train_generator = DataLoader(train_dataset, **params)
+train_generator = get_loader(train_dataset, pin_memory)
 
 # =============================================================
 # PRETRAIN THE SOFTMAX CLASSIFIER
@@ -66,18 +101,20 @@ train_generator = DataLoader(train_dataset, **params)
 model_name = "%s_disc_classifier" % args.dataset
 success = train_agent.load_model(model=model_name)
 if success:
-    print("Discriminative classifier parameters loaded...")
+    log("Discriminative classifier parameters loaded...")
 else:
-    print("Training the discriminative classifier...")
+    log("Training the discriminative classifier...")
     for ep in range(1, n_epochs + 1):
+        set_epoch(train_generator, ep)
         loss = 0
         for idx, (img_features, label_attr, label_idx) in enumerate(train_generator):
             l = train_agent.fit_classifier(img_features, label_attr, label_idx)
             loss += l
 
-        print("Loss for epoch: %3d - %.4f" %(ep, loss))
+        log("Loss for epoch: %3d - %.4f" %(ep, loss))
 
-    train_agent.save_model(model=model_name)
+    if is_main:
+        train_agent.save_model(model=model_name)
 
 # =============================================================
 # TRAIN THE GANs
@@ -85,21 +122,24 @@ else:
 model_name = "%s_gan" % args.dataset
 success = train_agent.load_model(model=model_name)
 if success:
-    print("\nGAN parameters loaded....")
+    log("\nGAN parameters loaded....")
 else:
-    print("\nTraining the GANS...")
+    log("\nTraining the GANS...")
     for ep in range(1, n_epochs + 1):
-        loss_dis = 0
-        loss_gan = 0
+        set_epoch(train_generator, ep)
+        # fp32 device accumulators, synced once per epoch when printing
+        loss_dis = torch.zeros((), device=device)
+        loss_gan = torch.zeros((), device=device)
         for idx, (img_features, label_attr, label_idx) in enumerate(train_generator):
             l_d, l_g = train_agent.fit_GAN(img_features, label_attr, label_idx, args.use_cls_loss)
             loss_dis += l_d
             loss_gan += l_g
 
-        print("Loss for epoch: %3d - D: %.4f | G: %.4f"\
-                %(ep, loss_dis, loss_gan))
+        log("Loss for epoch: %3d - D: %.4f | G: %.4f"\
+                %(ep, loss_dis.item(), loss_gan.item()))
 
-    train_agent.save_model(model=model_name)
+    if is_main:
+        train_agent.save_model(model=model_name)
 
 # =============================================================
 # TRAIN FINAL CLASSIFIER ON SYNTHETIC DATASET
@@ -114,29 +154,34 @@ syn_dataset = train_agent.create_syn_dataset(
         train_dataset.test_classmap, train_dataset.attributes, seen_dataset)
 final_dataset = ZSLDataset(args.dataset, n_train, n_test,
         gzsl=args.gzsl, train=True, synthetic=True, syn_dataset=syn_dataset)
-final_train_generator = DataLoader(final_dataset, **params)
+final_train_generator = get_loader(final_dataset)
 
 model_name = "%s_final_classifier" % args.dataset
 success = train_agent.load_model(model=model_name)
 if success:
-    print("\nFinal classifier parameters loaded....")
+    log("\nFinal classifier parameters loaded....")
 else:
-    print("\nTraining the final classifier on the synthetic dataset...")
+    log("\nTraining the final classifier on the synthetic dataset...")
     for ep in range(1, n_epochs + 1):
+        set_epoch(final_train_generator, ep)
         syn_loss = 0
         for idx, (img, label_attr, label_idx) in enumerate(final_train_generator):
             l = train_agent.fit_final_classifier(img, label_attr, label_idx)
             syn_loss += l
 
         # print losses on real and synthetic datasets
-        print("Loss for epoch: %3d - %.4f" %(ep, syn_loss))
+        log("Loss for epoch: %3d - %.4f" %(ep, syn_loss))
 
-    train_agent.save_model(model=model_name)
+    if is_main:
+        train_agent.save_model(model=model_name)
 
 # =============================================================
 # TESTING PHASE
 # =============================================================
 test_dataset = ZSLDataset(args.dataset, n_train, n_test, gzsl=args.gzsl, train=False)
-test_generator = DataLoader(test_dataset, **params)
+test_generator = DataLoader(test_dataset, shuffle=True, pin_memory=pin_memory, **params)
+
+log("\nFinal Accuracy on ZSL Task: %.3f" % train_agent.test(test_generator))
 
-print("\nFinal Accuracy on ZSL Task: %.3f" % train_agent.test(test_generator))
\ No newline at end of file
+if distributed:
+    dist.destroy_process_group()
@@ -53,10 +53,21 @@ class Resnet101(nn.Module):
         resnet101 = models.resnet101(pretrained=True)
         modules = list(resnet101.children())[:-1]
 
-        self.model = nn.Sequential(*modules)
+        # NHWC layout lets cuDNN pick its faster tensor core conv kernels
+        self.model = nn.Sequential(*modules).to(memory_format=torch.channels_last)
+        self.finetune = finetune
         if not finetune:
             for p in self.model.parameters():
                 p.requires_grad = False
+            self.model.eval()
+
+    def train(self, mode=True):
+        # frozen backbone always runs in eval mode to keep BatchNorm stats fixed
+        return super(Resnet101, self).train(mode and self.finetune)
 
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
+        if not self.finetune:
+            with torch.no_grad():
+                return self.model(x).squeeze()
         return self.model(x).squeeze()
@@ -1,13 +1,12 @@
 import torch
 import torch.autograd as autograd
 import torch.nn as nn
-import torch.nn.functional as F
 import torch.optim as optim
-from torch.distributions import uniform, normal
+from torch.nn.parallel import DistributedDataParallel as DDP
+from torch.utils.data import TensorDataset, ConcatDataset
 
+import contextlib
 import os
-import numpy as np
-from sklearn.metrics import accuracy_score
 
 from models import Generator, Discriminator, MLPClassifier, Resnet101
 
@@ -16,8 +15,11 @@ class Trainer:
         self, device, x_dim, z_dim, attr_dim, **kwargs):
         '''
         Trainer class.
+        Host to device copies of minibatches are non blocking, so DataLoaders
+        over host-side data should be created with pin_memory=True for them
+        to overlap with compute.
         Args:
-            device: CPU/GPU
+            device: CPU/GPU, the local GPU of this process when distributed
             x_dim: Dimension of image feature vector
             z_dim: Dimension of noise vector
             attr_dim: Dimension of attribute vector
@@ -33,6 +35,11 @@ class Trainer:
         self.lmbda = kwargs.get('lmbda', 10.0)
         self.beta = kwargs.get('beta', 0.01)
         self.bs = kwargs.get('batch_size', 32)
+        # accumulate critic grads over n_critic iterations and step once
+        self.critic_grad_accum = kwargs.get('critic_grad_accum', False)
+
+        self.distributed = kwargs.get('distributed', False)
+        self.compile = kwargs.get('compile', False)
 
         self.gzsl = kwargs.get('gzsl', False)
         self.n_train = kwargs.get('n_train')
@@ -40,39 +47,77 @@ class Trainer:
         if self.gzsl:
             self.n_test = self.n_train + self.n_test
 
-        self.eps_dist = uniform.Uniform(0, 1)
-        self.Z_dist = normal.Normal(0, 1)
-
         self.eps_shape = torch.Size([self.bs, 1])
-        self.z_shape = torch.Size([self.bs, self.z_dim])
 
-        self.net_G = Generator(self.z_dim, self.attr_dim).to(self.device)
+        self.net_G = self.wrap(Generator(self.z_dim, self.attr_dim).to(self.device))
         self.optim_G = optim.Adam(self.net_G.parameters(), lr=1e-4)
 
-        self.net_D = Discriminator(self.x_dim, self.attr_dim).to(self.device)
+        # torch.compile can't do the double backward of the gradient penalty
+        self.net_D = self.wrap(
+            Discriminator(self.x_dim, self.attr_dim).to(self.device), compile=False
+        )
         self.optim_D = optim.Adam(self.net_D.parameters(), lr=1e-4)
 
         # classifier for judging the output of generator
-        self.classifier = MLPClassifier(
+        self.classifier = self.wrap(MLPClassifier(
             self.x_dim, self.attr_dim, self.n_train
-        ).to(self.device)
+        ).to(self.device))
         self.optim_cls = optim.Adam(self.classifier.parameters(), lr=1e-4)
 
         # Final classifier trained on augmented data for GZSL
-        self.final_classifier = MLPClassifier(
+        self.final_classifier = self.wrap(MLPClassifier(
             self.x_dim, self.attr_dim, self.n_test
-        ).to(self.device)
+        ).to(self.device))
         self.optim_final_cls = optim.Adam(self.final_classifier.parameters(), lr=1e-4)
 
         self.criterion_cls = nn.CrossEntropyLoss()
 
+        # mixed precision is only used on GPU
+        self.use_amp = kwargs.get('use_amp', torch.device(self.device).type == 'cuda')
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
+
         self.model_save_dir = "saved_models"
-        if not os.path.exists(self.model_save_dir):
-            os.mkdir(self.model_save_dir)
+        # safe when several processes start at once
+        os.makedirs(self.model_save_dir, exist_ok=True)
+
+    def wrap(self, net, compile=True):
+        '''
+        Compile a network's forward with torch.compile if enabled and wrap it
+        for data parallel training across processes. Expects torch.distributed
+        to be initialized with one GPU per process.
+        '''
+        if self.compile and compile:
+            # compiles in place, so state dict keys are unchanged
+            net.compile()
+        if not self.distributed:
+            return net
+        return DDP(net, device_ids=[self.device.index], broadcast_buffers=False)
+
+    def unwrap(self, net):
+        '''
+        Returns the underlying network. Forward passes through the unwrapped
+        network skip gradient synchronization.
+        '''
+        return net.module if isinstance(net, DDP) else net
+
+    def no_sync(self, net, sync=False):
+        '''
+        Context skipping DDP gradient all-reduce for net unless sync is set.
+        '''
+        if sync or not isinstance(net, DDP):
+            return contextlib.nullcontext()
+        return net.no_sync()
+
+    def set_requires_grad(self, net, requires_grad):
+        for p in net.parameters():
+            p.requires_grad_(requires_grad)
+
+    def autocast(self, enabled=True):
+        return torch.cuda.amp.autocast(enabled=self.use_amp and enabled)
 
     def get_conditional_input(self, X, C_Y):
         new_X = torch.cat([X, C_Y], dim=1).float()
-        return autograd.Variable(new_X).to(self.device)
+        return new_X.to(self.device, non_blocking=True)
 
     def fit_classifier(self, img_features, label_attr, label_idx):
         '''
@@ -85,32 +130,40 @@ class Trainer:
         Returns:
             loss for the minibatch
         '''
-        img_features = autograd.Variable(img_features).to(self.device)
-        label_attr = autograd.Variable(label_attr).to(self.device)
-        label_idx = autograd.Variable(label_idx).to(self.device)
+        img_features = img_features.to(self.device, non_blocking=True)
+        label_attr = label_attr.to(self.device, non_blocking=True)
+        label_idx = label_idx.to(self.device, non_blocking=True)
 
         X_inp = self.get_conditional_input(img_features, label_attr)
-        Y_pred = self.classifier(X_inp)
+        with self.autocast():
+            Y_pred = self.classifier(X_inp)
+            loss = self.criterion_cls(Y_pred, label_idx)
 
-        self.optim_cls.zero_grad()
-        loss = self.criterion_cls(Y_pred, label_idx)
-        loss.backward()
-        self.optim_cls.step()
+        self.optim_cls.zero_grad(set_to_none=True)
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optim_cls)
+        self.scaler.update()
 
         return loss.item()
 
     def get_gradient_penalty(self, X_real, X_gen):
-        eps = self.eps_dist.sample(self.eps_shape).to(self.device)
+        eps = torch.rand(self.eps_shape, device=self.device)
         X_penalty = eps * X_real + (1 - eps) * X_gen
 
-        X_penalty = autograd.Variable(X_penalty, requires_grad=True).to(self.device)
-        critic_pred = self.net_D(X_penalty)
-        grad_outputs = torch.ones(critic_pred.size()).to(self.device)
-        gradients = autograd.grad(
-                outputs=critic_pred, inputs=X_penalty,
-                grad_outputs=grad_outputs,
-                create_graph=True, retain_graph=True, only_inputs=True
-        )[0]
+        X_penalty = X_penalty.detach().requires_grad_(True)
+        # double backward is kept in full precision
+        # goes through the unwrapped critic so that the DDP reducer only
+        # sees the single forward done in fit_GAN, the penalty's param grads
+        # are still reduced in the same backward
+        with self.autocast(enabled=False):
+            critic_pred = self.unwrap(self.net_D)(X_penalty)
+            # samples are independent, so a single VJP seeded with ones
+            # yields every per-sample input gradient at once
+            gradients = autograd.grad(
+                    outputs=critic_pred, inputs=X_penalty,
+                    grad_outputs=torch.ones_like(critic_pred),
+                    create_graph=True, retain_graph=True, only_inputs=True
+            )[0]
 
         grad_penalty = ((gradients.norm(2, dim=1) - 1) ** 2).mean()
         return grad_penalty
@@ -118,72 +171,113 @@ class Trainer:
     def fit_GAN(self, img_features, label_attr, label_idx, use_cls_loss=True):
         L_gen = 0
         L_disc = 0
-        total_L_disc = 0
+        # accumulated on the device to avoid a sync per critic iteration
+        total_L_disc = torch.zeros((), device=self.device)
 
-        img_features = autograd.Variable(img_features.float()).to(self.device)
-        label_attr = autograd.Variable(label_attr.float()).to(self.device)
-        label_idx = label_idx.to(self.device)
+        img_features = img_features.to(self.device, non_blocking=True).float()
+        label_attr = label_attr.to(self.device, non_blocking=True).float()
+        label_idx = label_idx.to(self.device, non_blocking=True)
 
         # =============================================================
         # optimize discriminator
         # =============================================================
         X_real = self.get_conditional_input(img_features, label_attr)
-        for _ in range(self.n_critic):
-            Z = self.Z_dist.sample(self.z_shape).to(self.device)
-            Z = self.get_conditional_input(Z, label_attr)
-
-            X_gen = self.net_G(Z)
-            X_gen = self.get_conditional_input(X_gen, label_attr)
 
-            # calculate normal GAN loss
-            L_disc = (self.net_D(X_gen) - self.net_D(X_real)).mean()
-
-            # calculate gradient penalty
-            grad_penalty = self.get_gradient_penalty(X_real, X_gen)
-            L_disc += self.lmbda * grad_penalty
-
-            # update critic params
-            self.optim_D.zero_grad()
-            L_disc.backward()
-            self.optim_D.step()
-
-            total_L_disc += L_disc.item()
+        # the attribute part of every conditional input is the same for the
+        # whole batch, so fill it in once and only overwrite the rest
+        Z = torch.empty((self.bs, self.z_dim + self.attr_dim), device=self.device)
+        Z[:, self.z_dim:] = label_attr
+        X_gen = torch.empty((self.bs, self.x_dim + self.attr_dim), device=self.device)
+        X_gen[:, self.x_dim:] = label_attr
+
+        if self.critic_grad_accum:
+            self.optim_D.zero_grad(set_to_none=True)
+
+        for i in range(self.n_critic):
+            # sample noise in place on the device, no host allocation or copy
+            Z[:, :self.z_dim].normal_()
+
+            # generator is not updated here, so don't record its graph
+            with torch.no_grad(), self.autocast():
+                X_gen[:, :self.x_dim] = self.net_G(Z)
+
+            # when accumulating, only the last iteration's critic forward
+            # runs outside no_sync, so grads are all-reduced once per batch
+            sync = not self.critic_grad_accum or i == self.n_critic - 1
+            with self.no_sync(self.net_D, sync=sync):
+                # calculate normal GAN loss, real and generated inputs share
+                # one critic forward
+                with self.autocast():
+                    critic_out = self.net_D(torch.cat([X_gen, X_real], dim=0))
+                    L_disc = (critic_out[:self.bs] - critic_out[self.bs:]).mean()
+
+                # calculate gradient penalty
+                grad_penalty = self.get_gradient_penalty(X_real, X_gen)
+                L_disc += self.lmbda * grad_penalty
+
+                # update critic params
+                if self.critic_grad_accum:
+                    self.scaler.scale(L_disc / self.n_critic).backward()
+                else:
+                    self.optim_D.zero_grad(set_to_none=True)
+                    self.scaler.scale(L_disc).backward()
+                    self.scaler.step(self.optim_D)
+                    self.scaler.update()
+
+            total_L_disc += L_disc.detach()
+
+        if self.critic_grad_accum:
+            self.scaler.step(self.optim_D)
+            self.scaler.update()
 
         # =============================================================
         # optimize generator
         # =============================================================
-        Z = self.Z_dist.sample(self.z_shape).to(self.device)
-        Z = self.get_conditional_input(Z, label_attr)
-
-        X_gen = self.net_G(Z)
-        X = torch.cat([X_gen, label_attr], dim=1).float()
-        L_gen = -1 * torch.mean(self.net_D(X))
-
-        if use_cls_loss:
-            self.classifier.eval()
-            Y_pred = F.softmax(self.classifier(X), dim=0)
-            log_prob = torch.log(torch.gather(Y_pred, 1, label_idx.unsqueeze(1)))
-            L_cls = -1 * torch.mean(log_prob)
-            L_gen += self.beta * L_cls
-
-        self.optim_G.zero_grad()
-        L_gen.backward()
-        self.optim_G.step()
-
-        return total_L_disc, L_gen.item()
+        # critic and classifier params are frozen so that only grads w.r.t.
+        # X_gen are computed
+        self.set_requires_grad(self.unwrap(self.net_D), False)
+        self.set_requires_grad(self.unwrap(self.classifier), False)
+
+        try:
+            Z[:, :self.z_dim].normal_()
+
+            with self.autocast():
+                X_gen = self.net_G(Z)
+                X = torch.cat([X_gen, label_attr], dim=1).float()
+                # critic and classifier are not updated here, no need to sync them
+                L_gen = -1 * torch.mean(self.unwrap(self.net_D)(X))
+
+                if use_cls_loss:
+                    self.classifier.eval()
+                    Y_pred = self.unwrap(self.classifier)(X)
+                    L_cls = self.criterion_cls(Y_pred, label_idx)
+                    L_gen += self.beta * L_cls
+
+            self.optim_G.zero_grad(set_to_none=True)
+            self.scaler.scale(L_gen).backward()
+            self.scaler.step(self.optim_G)
+            self.scaler.update()
+        finally:
+            self.set_requires_grad(self.unwrap(self.net_D), True)
+            self.set_requires_grad(self.unwrap(self.classifier), True)
+
+        # losses are returned as device tensors, callers sync when logging
+        return total_L_disc, L_gen.detach().float()
 
     def fit_final_classifier(self, img_features, label_attr, label_idx):
-        img_features = autograd.Variable(img_features.float()).to(self.device)
-        label_attr = autograd.Variable(label_attr.float()).to(self.device)
-        label_idx = label_idx.to(self.device)
+        img_features = img_features.to(self.device, non_blocking=True).float()
+        label_attr = label_attr.to(self.device, non_blocking=True).float()
+        label_idx = label_idx.to(self.device, non_blocking=True)
 
         X_inp = self.get_conditional_input(img_features, label_attr)
-        Y_pred = self.final_classifier(X_inp)
+        with self.autocast():
+            Y_pred = self.final_classifier(X_inp)
+            loss = self.criterion_cls(Y_pred, label_idx)
 
-        self.optim_final_cls.zero_grad()
-        loss = self.criterion_cls(Y_pred, label_idx)
-        loss.backward()
-        self.optim_final_cls.step()
+        self.optim_final_cls.zero_grad(set_to_none=True)
+        self.scaler.scale(loss).backward()
+        self.scaler.step(self.optim_final_cls)
+        self.scaler.update()
 
         return loss.item()
 
@@ -201,21 +295,30 @@ class Trainer:
                 latent representations of seen classes in GZSL
             n_samples: Number of samples of each unseen class to be generated(Default: 400)
         Returns:
-            A list of 3-tuple (z, _, y) where z is latent representations and y is
+            A dataset of 3-tuple (z, _, y) where z is latent representations and y is
         '''
-        syn_dataset = []
-        for test_cls, idx in test_labels.items():
-            attr = attributes[test_cls - 1]
-            z = self.Z_dist.sample(torch.Size([n_examples, self.z_dim]))
-            c_y = torch.stack([torch.FloatTensor(attr) for _ in range(n_examples)])
-
-            z_inp = self.get_conditional_input(z, c_y)
-            X_gen = self.net_G(z_inp)
-
-            syn_dataset.extend([(X_gen[i], test_cls, idx) for i in range(n_examples)])
+        test_cls = torch.tensor(list(test_labels.keys()), dtype=torch.long)
+        idx = torch.tensor(list(test_labels.values()), dtype=torch.long)
+
+        # all classes are generated in a single forward pass
+        attr = torch.as_tensor(
+            attributes[test_cls.numpy() - 1], dtype=torch.float32, device=self.device
+        )
+        c_y = attr.repeat_interleave(n_examples, dim=0)
+        z = torch.randn((c_y.size(0), self.z_dim), device=self.device)
+
+        z_inp = self.get_conditional_input(z, c_y)
+        with torch.no_grad():
+            X_gen = self.unwrap(self.net_G)(z_inp)
+
+        syn_dataset = TensorDataset(
+            X_gen,
+            test_cls.repeat_interleave(n_examples),
+            idx.repeat_interleave(n_examples)
+        )
 
         if seen_dataset is not None:
-            syn_dataset.extend(seen_dataset)
+            syn_dataset = ConcatDataset([syn_dataset, seen_dataset])
 
         return syn_dataset
 
@@ -225,71 +328,86 @@ class Trainer:
         else:
             model = self.final_classifier
 
-        # eval mode
+        # eval mode for the whole pass, restored afterwards
+        was_training = model.training
         model.eval()
-        batch_accuracies = []
-        for idx, (img_features, label_attr, label_idx) in enumerate(data_generator):
-            img_features = img_features.to(self.device)
-            label_attr = label_attr.to(self.device)
-
-            X_inp = self.get_conditional_input(img_features, label_attr)
-            with torch.no_grad():
-                Y_probs = model(X_inp)
-            _, Y_pred = torch.max(Y_probs, dim=1)
-
-            Y_pred = Y_pred.cpu().numpy()
-            Y_real = label_idx.cpu().numpy()
-
-            acc = accuracy_score(Y_pred, Y_real)
-            batch_accuracies.append(acc)
-        return np.mean(batch_accuracies)
+        n_correct = torch.zeros((), dtype=torch.long, device=self.device)
+        n_total = 0
+        try:
+            for idx, (img_features, label_attr, label_idx) in enumerate(data_generator):
+                img_features = img_features.to(self.device, non_blocking=True)
+                label_attr = label_attr.to(self.device, non_blocking=True)
+                label_idx = label_idx.to(self.device, non_blocking=True)
+
+                X_inp = self.get_conditional_input(img_features, label_attr)
+                with torch.no_grad():
+                    Y_probs = model(X_inp)
+                _, Y_pred = torch.max(Y_probs, dim=1)
+
+                # counted on the device, synced only once at the end
+                n_correct += (Y_pred == label_idx).sum()
+                n_total += label_idx.size(0)
+        finally:
+            model.train(was_training)
+        if n_total == 0:
+            # no full batch in the loader
+            return float('nan')
+        return n_correct.item() / n_total
+
+    def get_ckpt_path(self, name):
+        return os.path.join(self.model_save_dir, name + ".pth")
 
     def save_model(self, model=None):
         if "disc_classifier" in model:
-            ckpt_path = os.path.join(self.model_save_dir, model + ".pth")
-            torch.save(self.classifier.state_dict(), ckpt_path)
+            ckpt_path = self.get_ckpt_path(model)
+            torch.save(self.unwrap(self.classifier).state_dict(), ckpt_path)
 
         elif "gan" in model:
             dset_name = model.split('_')[0]
-            g_ckpt_path = os.path.join(self.model_save_dir, "%s_generator.pth" % dset_name)
-            torch.save(self.net_G.state_dict(), g_ckpt_path)
+            g_ckpt_path = self.get_ckpt_path("%s_generator" % dset_name)
+            torch.save(self.unwrap(self.net_G).state_dict(), g_ckpt_path)
 
-            d_ckpt_path = os.path.join(self.model_save_dir, "%s_discriminator.pth" % dset_name)
-            torch.save(self.net_D.state_dict(), d_ckpt_path)
+            d_ckpt_path = self.get_ckpt_path("%s_discriminator" % dset_name)
+            torch.save(self.unwrap(self.net_D).state_dict(), d_ckpt_path)
 
         elif "final_classifier" in model:
-            ckpt_path = os.path.join(self.model_save_dir, model + ".pth")
-            torch.save(self.final_classifier.state_dict(), ckpt_path)
+            ckpt_path = self.get_ckpt_path(model)
+            torch.save(self.unwrap(self.final_classifier).state_dict(), ckpt_path)
 
         else:
             raise Exception("Trying to save unknown model: %s" % model)
 
+    def read_checkpoint(self, ckpt_path):
+        # weights only, so no arbitrary pickled objects are executed, and
+        # memory mapped to avoid reading the whole file up front
+        return torch.load(ckpt_path, map_location=self.device, weights_only=True, mmap=True)
+
     def load_model(self, model=None):
         if "disc_classifier" in model:
-            ckpt_path = os.path.join(self.model_save_dir, model + ".pth")
+            ckpt_path = self.get_ckpt_path(model)
             if os.path.exists(ckpt_path):
-                self.classifier.load_state_dict(torch.load(ckpt_path))
+                self.unwrap(self.classifier).load_state_dict(self.read_checkpoint(ckpt_path))
                 return True
 
         elif "gan" in model:
             f1, f2 = False, False
             dset_name = model.split('_')[0]
-            g_ckpt_path = os.path.join(self.model_save_dir, "%s_generator.pth" % dset_name)
+            g_ckpt_path = self.get_ckpt_path("%s_generator" % dset_name)
             if os.path.exists(g_ckpt_path):
-                self.net_G.load_state_dict(torch.load(g_ckpt_path))
+                self.unwrap(self.net_G).load_state_dict(self.read_checkpoint(g_ckpt_path))
                 f1 = True
 
-            d_ckpt_path = os.path.join(self.model_save_dir, "%s_discriminator.pth" % dset_name)
+            d_ckpt_path = self.get_ckpt_path("%s_discriminator" % dset_name)
             if os.path.exists(d_ckpt_path):
-                self.net_D.load_state_dict(torch.load(d_ckpt_path))
+                self.unwrap(self.net_D).load_state_dict(self.read_checkpoint(d_ckpt_path))
                 f2 = True
 
             return f1 and f2
 
         elif "final_classifier" in model:
-            ckpt_path = os.path.join(self.model_save_dir, model + ".pth")
+            ckpt_path = self.get_ckpt_path(model)
             if os.path.exists(ckpt_path):
-                self.final_classifier.load_state_dict(torch.load(ckpt_path))
+                self.unwrap(self.final_classifier).load_state_dict(self.read_checkpoint(ckpt_path))
                 return True
 
         else: